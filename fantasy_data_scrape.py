@@ -1,9 +1,25 @@
-import requests
-from bs4 import BeautifulSoup
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
+from lxml import etree
+import numpy as np
+import gzip
+import io
 import json
 import time
 import os
-from collections import defaultdict
+import re
+import threading
+from collections import Counter, defaultdict, namedtuple
+from datetime import timedelta
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib encoder
+    orjson = None
 
 BASE_URL = "https://www.pro-football-reference.com"
 START_YEAR, END_YEAR = 2010, 2024
@@ -16,12 +32,101 @@ DATA_DIR = "data"
 os.makedirs(DATA_DIR, exist_ok=True)
 
 METADATA_FILE = "data/table_metadata.txt"
+HTTP_CACHE = "data/http_cache.sqlite"
+REQUESTS_PER_SECOND = 4  # aggregate cap across all workers, to avoid hammering site
+
+# Stats used for fantasy scoring, in a fixed order so calc_fantasy can score them as matrix columns
+FantasyStats = namedtuple(
+    "FantasyStats",
+    ["pass_yds", "pass_td", "interceptions", "rush_yds", "rush_td",
+     "rec", "rec_yds", "rec_td", "fumbles_lost", "two_pt"],
+)
+FANTASY_SLOTS = {
+    key: i for i, key in enumerate(
+        ["Pass Yds", "Pass TD", "Int", "Rush Yds", "Rush TD",
+         "Rec", "Rec Yds", "Rec TD", "Fumbles Lost", "2PM"]
+    )
+}
+
+# Standard scoring weight for each FantasyStats field (receptions only count in half/full PPR)
+FANTASY_WEIGHTS = np.array([1/25, 4, -2, 1/10, 6, 0, 1/10, 6, -2, 2])
+REC_SLOT = FantasyStats._fields.index("rec")
+
+# Only these parts of the fantasy and player pages are ever queried, so parse nothing else
+FANTASY_STRAINER = SoupStrainer("table", {"id": "fantasy"})
+NAV_STRAINER = SoupStrainer("div", {"id": "inner_nav"})
+
+# Canonical headers keyed by (id(unique_map), bottom-row fingerprint); every player's gamelog
+# for a season shares a schema, so the thead is only mapped once per layout. Entries hold
+# the map itself so its id can't be reused by a different map while cached.
+_HEADERS_CACHE = {}
+
+# Numeric cell text, checked up front instead of trying int()/float() and catching ValueError
+_NUM_RE = re.compile(r"-?(?:\d+\.?\d*|\.\d+)")
+
+# Season gamelog links end in /gamelog/{year}/, which gives the year without reading link text
+_YEAR_RE = re.compile(r"/gamelog/(\d{4})/?$")
+
+class TokenBucket:
+    """Thread-safe token bucket that bounds the aggregate request rate across all workers."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            # A negative balance reserves a future token; wait until it refills
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class RateLimitedAdapter(HTTPAdapter):
+    """HTTPAdapter that takes a token per request; cache hits never reach the adapter."""
+
+    def __init__(self, limiter, **kwargs):
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.limiter.acquire()
+        return super().send(request, **kwargs)
+
+RATE_LIMITER = TokenBucket(REQUESTS_PER_SECOND)
+
+def make_session():
+    """
+    Build a session that keeps connections to PFR alive and retries transient errors.
+    Responses (including 404s) are cached on disk so re-runs don't refetch pages.
+    """
+    session = requests_cache.CachedSession(
+        HTTP_CACHE,
+        expire_after=timedelta(days=30),
+        allowable_codes=(200, 404),
+    )
+    # ACCEPT_ENCODING only offers brotli when a decoder for it is installed
+    session.headers.update({"Accept-Encoding": ACCEPT_ENCODING, "User-Agent": "fantasy-stats/1.0"})
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    session.mount(
+        "https://",
+        RateLimitedAdapter(RATE_LIMITER, pool_connections=16, pool_maxsize=32, max_retries=retry),
+    )
+    return session
+
+SESSION = make_session()
 
 def get_table_metadata(url, filename=METADATA_FILE):
     """Extract table metadata (headers + categories + tooltips) from a player's game log page."""
-    soup = fetch_soup(url)
-    table = soup.find("table", {"id": "stats"})
-    if not table:
+    table = fetch_table(url, "stats")
+    if table is None:
         print(f"[WARN] No stats table found at {url}")
         return {}
 
@@ -29,41 +134,32 @@ def get_table_metadata(url, filename=METADATA_FILE):
     categories = []
     tips = []
 
-    thead = table.find("thead")
-    if thead:
-        rows = thead.find_all("tr")
-        if len(rows) >= 2:
-            top = rows[0].find_all("th")
-            bottom = rows[1].find_all("th")
-
-            # Map each bottom col to its category by colspan
-            cat_map = []
-            for th in top:
-                colspan = int(th.get("colspan", 1))
-                cat = th.get_text(strip=True)
-                cat_map.extend([cat] * colspan)
-
-            for i, th in enumerate(bottom):
-                col = th.get_text(strip=True)
-                cat = cat_map[i] if i < len(cat_map) else ""
-                tip = th.get("data-tip", "").strip()
-                headers.append(col)
-                categories.append(cat)
-                tips.append(tip)
-
-    # Build map (category, column) → unique name
-    name_count = {}
+    rows = table.xpath("thead/tr")
+    if len(rows) >= 2:
+        top = rows[0].iterchildren("th")
+        bottom = rows[1].iterchildren("th")
+
+        # Map each bottom col to its category by colspan
+        cat_map = []
+        for th in top:
+            colspan = int(th.get("colspan", 1))
+            cat = cell_text(th)
+            cat_map.extend([cat] * colspan)
+
+        for i, th in enumerate(bottom):
+            col = cell_text(th)
+            cat = cat_map[i] if i < len(cat_map) else ""
+            tip = th.get("data-tip", "").strip()
+            headers.append(col)
+            categories.append(cat)
+            tips.append(tip)
+
+    # Build map (category, column) → unique name; repeated column names get a category prefix
+    name_count = Counter(headers)
     meta = {}
     for cat, col, tip in zip(categories, headers, tips):
-        key = (cat, col)
-        base = col
-        if base in name_count:
-            name_count[base] += 1
-            unique = f"{cat[:2].lower()}{base}"
-        else:
-            name_count[base] = 1
-            unique = base
-        meta[key] = {"unique": unique, "tip": tip}
+        unique = col if name_count[col] == 1 else f"{cat[:2].lower()}{col}"
+        meta[(cat, col)] = {"unique": unique, "tip": tip}
 
     # Write to file if filename provided
     if filename:
@@ -83,15 +179,15 @@ def get_table_metadata_for_positions(year, positions=("QB", "RB", "WR", "TE"), f
     Collect metadata across multiple positions to build a universal schema.
     Looks up one player of each position (if available) from the fantasy stats page.
     """
-    url = f"{BASE_URL}/years/{year}/fantasy.htm"
-    soup = fetch_soup(url)
-    table = soup.find("table", {"id": "fantasy"})
+    table = fetch_fantasy_table(year)
     if not table:
         print(f"[WARN] No fantasy table for year {year}")
         return {}
 
     found = {}
     for row in table.tbody.find_all("tr"):
+        if len(found) == len(positions):
+            break
         if "class" in row.attrs and "thead" in row["class"]:
             continue
         pos_cell = row.find("td", {"data-stat": "fantasy_pos"})
@@ -99,28 +195,27 @@ def get_table_metadata_for_positions(year, positions=("QB", "RB", "WR", "TE"), f
         if not pos_cell or not name_cell or not name_cell.a:
             continue
         pos = pos_cell.get_text(strip=True)
-        if pos in positions and pos not in found:
-            player_link = BASE_URL + name_cell.a["href"]
-            # Use first available gamelog link
-            player_soup = fetch_soup(player_link)
-            nav = player_soup.find("div", {"id": "inner_nav"})
-            if not nav:
-                continue
-            game_log_header = nav.find("span", string="Game Logs")
-            if not game_log_header:
-                continue
-            ul = game_log_header.find_next("ul")
-            if not ul:
-                continue
-            first_link = ul.find("a", href=True)
-            if not first_link:
-                continue
-            gamelog_url = BASE_URL + first_link["href"]
-            print(f"[INFO] Fetching metadata from {pos} {name_cell.a.text} → {gamelog_url}")
-            meta = get_table_metadata(gamelog_url, filename=None)  # don’t overwrite file yet
-            found[pos] = meta
-            if len(found) == len(positions):
-                break
+        if pos not in positions or pos in found:
+            continue
+
+        player_link = BASE_URL + name_cell.a["href"]
+        # Use first available gamelog link
+        player_soup = fetch_soup(player_link, parse_only=NAV_STRAINER)
+        nav = player_soup.find("div", {"id": "inner_nav"})
+        if not nav:
+            continue
+        game_log_header = nav.find("span", string="Game Logs")
+        if not game_log_header:
+            continue
+        ul = game_log_header.find_next("ul")
+        if not ul:
+            continue
+        first_link = ul.find("a", href=True)
+        if not first_link:
+            continue
+        gamelog_url = BASE_URL + first_link["href"]
+        print(f"[INFO] Fetching metadata from {pos} {name_cell.a.text} → {gamelog_url}")
+        found[pos] = get_table_metadata(gamelog_url, filename=None)  # don’t overwrite file yet
 
     # Merge all metadata
     merged = {}
@@ -130,25 +225,80 @@ def get_table_metadata_for_positions(year, positions=("QB", "RB", "WR", "TE"), f
     # Save to file
     os.makedirs(os.path.dirname(filename), exist_ok=True)
     with open(filename, "w", encoding="utf-8") as f:
-        for (cat, col), info in meta.items():
+        for (cat, col), info in merged.items():
             unique = info["unique"]
             tip = info["tip"]
             f.write(f"{cat},{col}:{unique} | {tip}\n")
 
-
     print(f"[INFO] Universal metadata saved with {len(merged)} headers")
     return merged
 
-def fetch_soup(url):
-    res = requests.get(url)
+def player_file(player_id):
+    """Path of a player's saved data; its existence means the player is already scraped."""
+    return os.path.join(DATA_DIR, f"{player_id}.json.gz")
+
+def save_player(player_id, pdata):
+    """Write one player's scraped data to DATA_DIR as gzipped compact JSON and return the path."""
+    filepath = player_file(player_id)
+    # Write to a temp file and rename it into place, so an interrupted write never
+    # leaves a partial file that later runs would take as a finished player
+    tmp_path = filepath + ".tmp"
+    if orjson is not None:
+        with gzip.open(tmp_path, "wb", compresslevel=3) as f:
+            f.write(orjson.dumps(pdata))
+    else:
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=3) as f:
+            json.dump(pdata, f, separators=(",", ":"), ensure_ascii=False)
+    os.replace(tmp_path, filepath)
+    return filepath
+
+def unique_names(metadata_map):
+    """Flatten metadata to (category, column) → unique name, the only field the scrape loop reads."""
+    return {key: info["unique"] for key, info in metadata_map.items()}
+
+def fetch_content(url, missing_ok=False):
+    """Fetch a page's raw bytes; with missing_ok, a (possibly cached) 404 returns None instead of raising."""
+    res = SESSION.get(url, timeout=15)
+    if missing_ok and res.status_code == 404:
+        return None
     res.raise_for_status()
-    return BeautifulSoup(res.text, "html.parser")
+    return res.content
+
+def fetch_soup(url, parse_only=None):
+    return BeautifulSoup(fetch_content(url), "lxml", parse_only=parse_only)
+
+def cell_text(elem):
+    """Stripped text of an lxml element and its descendants."""
+    return "".join(elem.itertext()).strip()
+
+def fetch_table(url, table_id):
+    """
+    Fetch a page and return its <table id=table_id> as an lxml element, or None if the
+    page is missing (404) or has no such table.
+    Parsing stops as soon as the table closes, so the rest of the page is never built.
+    """
+    content = fetch_content(url, missing_ok=True)
+    if content is None:
+        return None
+    source = io.BytesIO(content)
+    for _, elem in etree.iterparse(source, events=("end",), tag="table", html=True):
+        if elem.get("id") == table_id:
+            return elem
+    return None
+
+@lru_cache(maxsize=1)
+def fetch_fantasy_table(year):
+    """
+    Fetch the fantasy stats table for a year. The metadata pass and the player
+    listing both read START_YEAR's table, so keep the last one parsed.
+    """
+    url = f"{BASE_URL}/years/{year}/fantasy.htm"
+    soup = fetch_soup(url, parse_only=FANTASY_STRAINER)
+    return soup.find("table", {"id": "fantasy"})
 
 def get_players_for_year(year):
     """Get all players listed on the fantasy stats page for a given year."""
-    url = f"{BASE_URL}/years/{year}/fantasy.htm"
-    soup = fetch_soup(url)
-    table = soup.find("table", {"id": "fantasy"})
+    table = fetch_fantasy_table(year)
     players = []
     for row in table.tbody.find_all("tr"):
         if "class" in row.attrs and "thead" in row["class"]:
@@ -163,14 +313,14 @@ def get_players_for_year(year):
     print(f"Found {len(players)} players for {year}")
     return players
 
-def scrape_player(player_id, player_name, player_url, metadata_map):
+def scrape_player(player_id, player_name, player_url, unique_map):
     """Scrape all available game logs for one player across years."""
     if player_id in seen_players:
         return None
     seen_players.add(player_id)
 
     data = {"name": player_name, "id": player_id, "years": {}}
-    soup = fetch_soup(player_url)
+    soup = fetch_soup(player_url, parse_only=NAV_STRAINER)
 
     nav = soup.find("div", {"id": "inner_nav"})
     if not nav:
@@ -189,59 +339,47 @@ def scrape_player(player_id, player_name, player_url, metadata_map):
 
     # Collect year → url map once
     year_links = {}
-    for link in ul.find_all("a", href=True):
-        if "/gamelog/" not in link["href"]:
-            continue
-        year = link.text.strip()
-        if not year.isdigit():
-            continue
-        year = int(year)
+    for link in ul.find_all("a", href=_YEAR_RE):
+        href = link["href"]
+        year = int(_YEAR_RE.search(href).group(1))
         if year < START_YEAR or year > END_YEAR:
             continue
-        year_links[year] = BASE_URL + link["href"]
+        year_links[year] = BASE_URL + href
 
     # Process each year
     for year, year_url in sorted(year_links.items()):
         print(f"  Scraping {year} game log for {player_name}...")
-        year_data = scrape_gamelog(year_url, metadata_map)
+        year_data = scrape_gamelog(year_url, unique_map)
         if year_data:
             data["years"][str(year)] = year_data
-        time.sleep(1)
 
     return data
 
-def scrape_gamelog(url, metadata_map):
-    soup = fetch_soup(url)
-    table = soup.find("table", {"id": "stats"})
-    if not table:
-        print(f"    No stats table found at {url}")
-        return None
-
-    # --- Extract headers ---
+def parse_headers(table, bottom, unique_map):
+    """Map a stats table's bottom header row to canonical names, logging any unknown headers."""
     over_headers = []
-    for tr in table.find("thead").find_all("tr")[:-1]:
-        cells = tr.find_all("th")
-        for cell in cells:
+    for tr in table.xpath("thead/tr[position() < last()]"):
+        for cell in tr.iterchildren("th"):
             col_span = int(cell.get("colspan", 1))
-            label = cell.get_text(strip=True)
+            label = cell_text(cell)
             over_headers.extend([label] * col_span)
 
-    bottom = table.find("thead").find_all("tr")[-1].find_all("th")
     col_pairs = []
     for idx, th in enumerate(bottom):
         if th.get("data-stat") == "ranker":
             continue
-        col = th.get_text(strip=True)
+        col = cell_text(th)
         cat = over_headers[idx] if idx < len(over_headers) else ""
         tip = th.get("data-tip", "").strip()
         col_pairs.append((cat, col, tip))
 
-    # --- Map to canonical headers using metadata_map ---
+    # --- Map to canonical headers using unique_map ---
     headers = []
     for cat, col, tip in col_pairs:
         key = (cat, col)
-        if key in metadata_map:
-            headers.append(metadata_map[key]["unique"])
+        unique = unique_map.get(key)
+        if unique is not None:
+            headers.append(unique)
         else:
             # Unknown header → create fallback, log it
             fallback = f"{cat}_{col}".strip("_")
@@ -250,31 +388,47 @@ def scrape_gamelog(url, metadata_map):
                 f.write(f"{cat},{col}:{fallback} | {tip}\n")
             print(f"[WARN] New header found: {key}")
 
+    return headers
+
+def scrape_gamelog(url, unique_map):
+    table = fetch_table(url, "stats")
+    if table is None:
+        print(f"    No stats table found at {url}")
+        return None
+
+    # --- Extract headers (reused across gamelogs that share a schema) ---
+    bottom = table.xpath("thead/tr[last()]/th")
+    fingerprint = tuple(th.get("data-stat") or cell_text(th) for th in bottom)
+    cache_key = (id(unique_map), fingerprint)
+    cached = _HEADERS_CACHE.get(cache_key)
+    if cached is not None and cached[0] is unique_map:
+        headers = cached[1]
+    else:
+        headers = parse_headers(table, bottom, unique_map)
+        _HEADERS_CACHE[cache_key] = (unique_map, headers)
+
     # --- Extract rows ---
     games = []
-    for row in table.tbody.find_all("tr"):
-        if "class" in row.attrs and "thead" in row["class"]:
-            continue
-        cells = row.find_all(["th", "td"])
-        if not cells or not cells[0].text.strip().isdigit():
+    stat_rows = []
+    for row in table.xpath('tbody/tr[not(contains(@class, "thead"))]'):
+        cells = [cell_text(c) for c in row.iterchildren("th", "td")]
+        if not cells or not cells[0].isdigit():
             continue
 
         game_data = {}
-        for i, cell in enumerate(cells[1:], start=0):
+        slots = [0] * len(FANTASY_SLOTS)
+        for i, val in enumerate(cells[1:], start=0):
             if i >= len(headers):
                 continue
             header = headers[i]
-            val = cell.get_text(strip=True)
-            try:
-                game_data[header] = float(val) if "." in val else int(val)
-            except ValueError:
+            if not _NUM_RE.fullmatch(val):
                 game_data[header] = val
-
-        # Fill in missing attributes with 0
-        for info in metadata_map.values():
-            uniq = info["unique"]
-            if uniq not in game_data:
-                game_data[uniq] = 0
+                continue
+            num = float(val) if "." in val else int(val)
+            game_data[header] = num
+            slot = FANTASY_SLOTS.get(header)
+            if slot is not None:
+                slots[slot] = num
 
         week_val = game_data.get("Week")
         if not week_val or not str(week_val).isdigit():
@@ -288,48 +442,36 @@ def scrape_gamelog(url, metadata_map):
             "home": game_data.get("game_location", "") != "@",
             "stats": game_data,
         }
-        game["fantasy"] = calc_fantasy(game_data)
         games.append(game)
+        stat_rows.append(FantasyStats(*slots))
 
-    return {"games": games}
-
-
-def calc_fantasy(stats):
-    """Calculate fantasy points from raw stats dictionary."""
-    def g(key):
-        val = stats.get(key, 0)
-        return val if isinstance(val, (int, float)) else 0
-
-    pass_yds = g("Pass Yds")
-    pass_td  = g("Pass TD")
-    interceptions = g("Int")
+    for game, points in zip(games, calc_fantasy(stat_rows)):
+        game["fantasy"] = points
 
-    rush_yds = g("Rush Yds")
-    rush_td  = g("Rush TD")
+    return {"games": games}
 
-    rec = g("Rec")
-    rec_yds = g("Rec Yds")
-    rec_td  = g("Rec TD")
 
-    fumbles_lost = g("Fumbles Lost")
-    two_pt = g("2PM")
+def calc_fantasy(stat_rows):
+    """Calculate fantasy points for a batch of FantasyStats tuples, one dict per game."""
+    if not stat_rows:
+        return []
+    stats = np.array(stat_rows, dtype=np.float64)
 
-    std = (
-        (pass_yds/25) +( pass_td*4) - (interceptions*2)
-        + (rush_yds/10) + (rush_td*6)
-        + (rec_yds/10) + (rec_td*6)
-        + (two_pt*2) - (fumbles_lost*2)
-    )
-    half = std + rec*0.5
-    ppr = std + rec*1.0
+    std = stats @ FANTASY_WEIGHTS
+    half = std + stats[:, REC_SLOT]*0.5
+    ppr = std + stats[:, REC_SLOT]*1.0
 
-    return {"standard": round(std, 2), "half_ppr": round(half, 2), "ppr": round(ppr, 2)}
+    return [
+        {"standard": s, "half_ppr": h, "ppr": p}
+        for s, h, p in zip(np.round(std, 2).tolist(), np.round(half, 2).tolist(), np.round(ppr, 2).tolist())
+    ]
 
 
 if __name__ == "__main__":
     # Step 1: Build metadata once
     print("=== Building universal metadata ===")
     metadata_map = get_table_metadata_for_positions(START_YEAR)
+    unique_map = unique_names(metadata_map)
 
     # Step 2: Scrape all players
     all_players = {}
@@ -338,10 +480,12 @@ if __name__ == "__main__":
         for pid, name, url in get_players_for_year(year):
             if pid in seen_players:
                 continue
+            if os.path.exists(player_file(pid)):
+                seen_players.add(pid)
+                continue
             print(f"Scraping {name} [{pid}]")
-            pdata = scrape_player(pid, name, url, metadata_map)  # no getMetadata flag needed now
+            pdata = scrape_player(pid, name, url, unique_map)  # no getMetadata flag needed now
             if pdata:
                 all_players[pid] = pdata
-                with open(f"data/{pid}.json", "w") as f:
-                    json.dump(pdata, f, indent=2)
+                save_player(pid, pdata)
 
@@ -1,10 +1,13 @@
-import json
 import os
-from multiprocessing import Pool, cpu_count
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from fantasy_data_scrape import (
     get_players_for_year,
     scrape_player,
+    save_player,
+    player_file,
     get_table_metadata_for_positions,
+    unique_names,
     START_YEAR,
     END_YEAR,
 )
@@ -12,16 +15,16 @@ from fantasy_data_scrape import (
 DATA_DIR = "data"
 os.makedirs(DATA_DIR, exist_ok=True)
 
+WORKERS = 24  # threads mostly wait on the network; the session's rate limiter bounds the request rate
 
-def scrape_wrapper(args):
-    """Wrapper for multiprocessing scrape calls."""
-    pid, name, url, metadata_map = args
+
+def scrape_wrapper(args, unique_map):
+    """Wrapper for concurrent scrape calls."""
+    pid, name, url = args
     try:
-        pdata = scrape_player(pid, name, url, metadata_map)
+        pdata = scrape_player(pid, name, url, unique_map)
         if pdata:
-            filepath = os.path.join(DATA_DIR, f"{pid}.json")
-            with open(filepath, "w", encoding="utf-8") as f:
-                json.dump(pdata, f, indent=2)
+            filepath = save_player(pid, pdata)
             print(f"[OK] Saved {name} ({pid}) → {filepath}")
         return pdata
     except Exception as e:
@@ -33,24 +36,25 @@ def main():
     # Step 1: Build universal metadata
     print("=== Building universal metadata ===")
     metadata_map = get_table_metadata_for_positions(START_YEAR)
+    unique_map = unique_names(metadata_map)
 
     # Step 2: Gather all players across years
-    all_players = []
+    players = {}
     for year in range(START_YEAR, END_YEAR + 1):
         print(f"=== Collecting players for {year} ===")
-        players = get_players_for_year(year)
-        # players = [(pid, name, team, url)]
-        for pid, name, _, url in players:
-            all_players.append((pid, name, url, metadata_map))
+        for pid, name, url in get_players_for_year(year):
+            players.setdefault(pid, (pid, name, url))
 
+    # Skip players already saved by a previous run
+    all_players = [p for p in players.values() if not os.path.exists(player_file(p[0]))]
+    print(f"Skipping {len(players) - len(all_players)} already scraped players")
     print(f"Total players to scrape: {len(all_players)}")
 
-    # Step 3: Parallel scrape
-    workers = min(cpu_count(), 8)  # cap at 8 to avoid hammering site
-    print(f"=== Starting scrape with {workers} workers ===")
-
-    with Pool(processes=workers) as pool:
-        pool.map(scrape_wrapper, all_players)
+    # Step 3: Concurrent scrape
+    print(f"=== Starting scrape with {WORKERS} workers ===")
+    with ThreadPoolExecutor(max_workers=WORKERS) as ex:
+        # Worker threads share memory, so every task can reference the same map
+        list(ex.map(partial(scrape_wrapper, unique_map=unique_map), all_players))
 
 
 if __name__ == "__main__":